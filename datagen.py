@@ -1,13 +1,41 @@
 import os
+import click
 import numpy as np
 from tqdm import tqdm
 
 N = 32
 samples_dir = "/tmp/samples/"
 targets_dir = "/tmp/targets/"
+dataset_dir = "/tmp/dataset/"
 
-for ii in tqdm(range(N)):
-    sample = np.random.uniform(size=(76800,))
-    target = np.random.uniform(size=(76800,))
-    np.save(samples_dir + "/sample_%d.npy" % ii, sample)
-    np.save(targets_dir + "/adj_sample_%d.npy" % ii, target)
+
+@click.command()
+@click.option(
+    "--packed",
+    help="Write all samples and targets to two 2D .npy files in %s instead of one file per sample"
+    % dataset_dir,
+    is_flag=True,
+    default=False,
+    show_default=True,
+)
+def datagen(packed):
+    # Draw every sample and target in one call; training reads them as float32.
+    rng = np.random.default_rng()
+    data = rng.uniform(size=(N, 2, 76800)).astype(np.float32)
+
+    if packed:
+        os.makedirs(dataset_dir, exist_ok=True)
+        np.save(dataset_dir + "/samples.npy", data[:, 0])
+        np.save(dataset_dir + "/targets.npy", data[:, 1])
+        return
+
+    os.makedirs(samples_dir, exist_ok=True)
+    os.makedirs(targets_dir, exist_ok=True)
+
+    for ii in tqdm(range(N), mininterval=1.0, miniters=max(1, N // 100)):
+        np.save(samples_dir + "/sample_%d.npy" % ii, data[ii, 0])
+        np.save(targets_dir + "/adj_sample_%d.npy" % ii, data[ii, 1])
+
+
+if __name__ == "__main__":
+    datagen()
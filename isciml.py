@@ -3,16 +3,29 @@ import numpy as np
 import pandas as pd
 import logging
 from rich.logging import RichHandler
-from rich.progress import track
 from rich.console import Console
 from tqdm import tqdm
 import sys
 import yaml
 import os
+import re
 import pyvista as pv
 import torch
 
 from mpi4py import MPI
+
+# Share the cores available to this process between the MPI ranks on the node;
+# this has to be set before numba starts its thread pool.
+_node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+_ranks_per_node = _node_comm.Get_size()
+_node_comm.Free()
+if hasattr(os, "sched_getaffinity"):
+    _n_cpus = len(os.sched_getaffinity(0))
+else:
+    _n_cpus = os.cpu_count() or 1
+_threads_per_rank = max(1, _n_cpus // _ranks_per_node)
+os.environ.setdefault("NUMBA_NUM_THREADS", str(_threads_per_rank))
+
 import adjoint
 import forward
 from random import sample
@@ -26,6 +39,13 @@ from torch.utils.data import Dataset, DataLoader
 import lightning.pytorch as pl
 import multiprocessing as mp
 
+try:
+    from numba import njit, prange
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 
 console = Console()
 comm = MPI.COMM_WORLD
@@ -41,6 +61,77 @@ logging.basicConfig(
 )
 log = logging.getLogger("rich")
 
+# Fixed leading dimension of the arrays expected by the adjoint/forward extensions
+MAX_ARRAY_SIZE = 1000000
+
+
+def _extension_arg_dtype(routine, position: int, default=np.int32) -> np.dtype:
+    # f2py documents the call as "out = name(arg1,arg2,...)" followed by one
+    # "argN : input rank-2 array('i') with bounds (...)" line per argument.
+    doc = routine.__doc__ or ""
+    signature = re.search(r"=\s*\w+\(([^)]*)\)", doc)
+    if signature:
+        args = [a.strip(" []") for a in signature.group(1).split(",")]
+        if position < len(args):
+            arg = re.search(
+                r"^\s*%s\s*:.*array\('(\w)'\)" % re.escape(args[position]),
+                doc,
+                re.M,
+            )
+            if arg:
+                return np.dtype(arg.group(1))
+    log.warning(
+        "Could not read argument %d of %s, assuming %s"
+        % (position, getattr(routine, "__name__", routine), np.dtype(default))
+    )
+    return np.dtype(default)
+
+
+# Integer type of the tetrahedron connectivity argument of the extensions, so the
+# connectivity is cast once and not converted by f2py on every call.
+TETS_DTYPE = _extension_arg_dtype(adjoint.adjoint, 10)
+
+
+def _tet_volumes_numpy(nodes, tets, out):
+    p = nodes[tets]
+    e1 = p[:, 1] - p[:, 0]
+    e2 = p[:, 2] - p[:, 0]
+    e3 = p[:, 3] - p[:, 0]
+    np.abs(np.einsum("ij,ij->i", e3, np.cross(e1, e2)), out=out)
+    out /= 6.0
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _tet_volumes(nodes, tets, out):
+        for i in prange(tets.shape[0]):
+            n1 = tets[i, 0]
+            n2 = tets[i, 1]
+            n3 = tets[i, 2]
+            n4 = tets[i, 3]
+            x1 = nodes[n1, 0]
+            y1 = nodes[n1, 1]
+            z1 = nodes[n1, 2]
+            ax = nodes[n2, 0] - x1
+            ay = nodes[n2, 1] - y1
+            az = nodes[n2, 2] - z1
+            bx = nodes[n3, 0] - x1
+            by = nodes[n3, 1] - y1
+            bz = nodes[n3, 2] - z1
+            cx = nodes[n4, 0] - x1
+            cy = nodes[n4, 1] - y1
+            cz = nodes[n4, 2] - z1
+            pv = (
+                cx * (ay * bz - az * by)
+                + cy * (az * bx - ax * bz)
+                + cz * (ax * by - ay * bx)
+            )
+            out[i] = abs(pv) / 6.0
+
+else:
+    _tet_volumes = _tet_volumes_numpy
+
 
 class Mesh:
     def __init__(self, vtk_file_name: Union[str, os.PathLike]):
@@ -61,8 +152,12 @@ class Mesh:
 
         self.npts = self.mesh.n_points
         self.ncells = self.mesh.n_cells
-        self.nodes = np.array(self.mesh.points)
-        self.tet_nodes = self.mesh.cell_connectivity.reshape((-1, 4))
+        # Views onto the VTK buffers where possible; the connectivity is cast once
+        # here to the integer type expected by the extensions.
+        self.nodes = np.asarray(self.mesh.points, dtype=np.float64)
+        self.tet_nodes = np.ascontiguousarray(
+            np.asarray(self.mesh.cell_connectivity).reshape((-1, 4)), dtype=TETS_DTYPE
+        )
 
         log.debug("Generated mesh properties")
 
@@ -71,63 +166,46 @@ class Mesh:
 
     def get_centroids(self):
         log.debug("Getting centroids")
-        nk = self.tet_nodes[:, 0]
-        nl = self.tet_nodes[:, 1]
-        nm = self.tet_nodes[:, 2]
-        nn = self.tet_nodes[:, 3]
-        self.centroids = (
-            self.nodes[nk, :]
-            + self.nodes[nl, :]
-            + self.nodes[nm, :]
-            + self.nodes[nn, :]
-        ) / 4.0
+        self.centroids = self.nodes[self.tet_nodes].mean(axis=1)
 
         log.debug("Getting centroids done!")
 
     def get_volumes(self):
         log.debug("Getting volumes")
         ntt = len(self.tet_nodes)
-        vot = np.zeros((ntt))
-        for itet in np.arange(0, ntt):
-            n1 = self.tet_nodes[itet, 0]
-            n2 = self.tet_nodes[itet, 1]
-            n3 = self.tet_nodes[itet, 2]
-            n4 = self.tet_nodes[itet, 3]
-            x1 = self.nodes[n1, 0]
-            y1 = self.nodes[n1, 1]
-            z1 = self.nodes[n1, 2]
-            x2 = self.nodes[n2, 0]
-            y2 = self.nodes[n2, 1]
-            z2 = self.nodes[n2, 2]
-            x3 = self.nodes[n3, 0]
-            y3 = self.nodes[n3, 1]
-            z3 = self.nodes[n3, 2]
-            x4 = self.nodes[n4, 0]
-            y4 = self.nodes[n4, 1]
-            z4 = self.nodes[n4, 2]
-            pv = (
-                (x4 - x1) * ((y2 - y1) * (z3 - z1) - (z2 - z1) * (y3 - y1))
-                + (y4 - y1) * ((z2 - z1) * (x3 - x1) - (x2 - x1) * (z3 - z1))
-                + (z4 - z1) * ((x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1))
-            )
-            vot[itet] = np.abs(pv / 6.0)
+        vot = np.empty((ntt), dtype=np.float64)
+        _tet_volumes(self.nodes, self.tet_nodes, vot)
         self.volumes = vot
 
         log.debug("Getting volumes done!")
 
 
-class MagneticProperties:
-    def __init__(
-        self, file_name: Union[str, os.PathLike], ambient_magnetic_field: List[float]
-    ):
-        log.debug("Reading magnetic properties %s" % file_name)
-        if os.path.exists(file_name):
-            self.file_name = file_name
-        else:
-            msg = "File %s does not exist" % file_name
+class AmbientField:
+    def __init__(self, ambient_magnetic_field: List[float]):
+        if len(ambient_magnetic_field) != 3:
+            msg = (
+                "Length of ambient magnetic field has to be exactly 3, passed a length of %d"
+                % len(ambient_magnetic_field)
+            )
             log.error(msg)
             raise ValueError(msg)
 
+        self.Bx = ambient_magnetic_field[0]
+        self.By = ambient_magnetic_field[1]
+        self.Bz = ambient_magnetic_field[2]
+        self.Bv = np.sqrt(self.Bx**2 + self.By**2 + self.Bz**2)
+
+        self.LX = self.Bx / self.Bv
+        self.LY = self.By / self.Bv
+        self.LZ = self.Bz / self.Bv
+
+
+class MagneticProperties:
+    def __init__(self, file_name: Union[str, os.PathLike], ambient_field: AmbientField):
+        log.debug("Reading magnetic properties %s" % file_name)
+        self.file_name = file_name
+
+        # A missing or unreadable file is reported by np.load below.
         try:
             self.properties = np.load(file_name)
         except Exception as e:
@@ -142,31 +220,30 @@ class MagneticProperties:
             log.error(msg)
             raise ValueError(msg)
 
+        # A 1D file holds only susceptibility, the common case, so it is used as
+        # is and the magnetization direction falls back to the ambient field.
         if self.properties.ndim == 1:
-            self.properties = np.expand_dims(self.properties, axis=1)
-
-        if self.properties.shape[1] > 0:
-            self.susceptibility = self.properties[:, 0]
-
-        Bx = ambient_magnetic_field[0]
-        By = ambient_magnetic_field[1]
-        Bz = ambient_magnetic_field[2]
-        Bv = np.sqrt(Bx**2 + By**2 + Bz**2)
+            n_columns = 1
+            self.susceptibility = self.properties
+        else:
+            n_columns = self.properties.shape[1]
+            if n_columns > 0:
+                self.susceptibility = self.properties[:, 0]
 
-        if self.properties.shape[1] > 1:
+        if n_columns > 1:
             self.kx = self.properties[:, 1]
         else:
-            self.kx = Bx / Bv
+            self.kx = ambient_field.LX
 
-        if self.properties.shape[1] > 2:
+        if n_columns > 2:
             self.ky = self.properties[:, 2]
         else:
-            self.ky = By / Bv
+            self.ky = ambient_field.LY
 
-        if self.properties.shape[1] > 3:
+        if n_columns > 3:
             self.kz = self.properties[:, 3]
         else:
-            self.kz = Bz / Bv
+            self.kz = ambient_field.LZ
 
         log.debug("Setting all magnetic properties done!")
 
@@ -175,7 +252,7 @@ class MagneticSolver:
     def __init__(
         self,
         reciever_file_name: Union[str, os.PathLike],
-        ambient_magnetic_field: List[float],
+        ambient_field: AmbientField,
         header,
         perturb_receiver_z,
     ):
@@ -188,40 +265,90 @@ class MagneticSolver:
 
         try:
             if header:
-                self.receiver_locations = pd.read_csv(reciever_file_name)
+                receiver_locations = pd.read_csv(reciever_file_name)
             else:
-                self.receiver_locations = pd.read_csv(reciever_file_name, header=None)
-            log.debug("Receiver file shape: " + str(self.receiver_locations.shape))
+                receiver_locations = pd.read_csv(reciever_file_name, header=None)
+            log.debug("Receiver file shape: " + str(receiver_locations.shape))
+            # Only x, y, z are used by the solver; keep them as a plain array so
+            # they are not converted from the DataFrame again.
+            self.receiver_locations = np.ascontiguousarray(
+                receiver_locations.to_numpy()[:, 0:3], dtype=np.float64
+            )
         except Exception as e:
             log.error(e)
             raise ValueError(e)
 
         if perturb_receiver_z:
             zpts = np.random.normal(
-                self.receiver_locations.iloc[:, 2].median(),
-                self.receiver_locations.iloc[:, 2].std(),
-                len(self.receiver_locations.iloc[:, 2]),
+                np.median(self.receiver_locations[:, 2]),
+                np.std(self.receiver_locations[:, 2], ddof=1),
+                len(self.receiver_locations),
             )
-            self.receiver_locations.iloc[:, 2] = zpts
+            self.receiver_locations[:, 2] = zpts
 
-        if len(ambient_magnetic_field) != 3:
+        self.ambient_field = ambient_field
+        self.Bv = ambient_field.Bv
+        self.LX = ambient_field.LX
+        self.LY = ambient_field.LY
+        self.LZ = ambient_field.LZ
+
+        self._buffers = {}
+        self._buffer_fill = {}
+        self._mesh = None
+
+        log.debug("Solver initialization done!")
+
+    def _fill_buffer(self, name, values, n, shape, dtype=float) -> np.ndarray:
+        # Zero-padded buffers are allocated once and reused across solve() calls;
+        # only the rows written by a previous, larger fill are cleared again.
+        buf = self._buffers.get(name)
+        if buf is None:
+            buf = np.zeros(shape, dtype=dtype, order="F")
+            self._buffers[name] = buf
+            filled = 0
+        else:
+            filled = self._buffer_fill[name]
+        buf[0:n] = values
+        if filled > n:
+            buf[n:filled] = 0
+        self._buffer_fill[name] = n
+        return buf
+
+    def prepare(self, mesh: Mesh):
+        # Mesh and receiver buffers only change with the mesh, so they are filled
+        # here once instead of on every solve() call.
+        log.debug("Preparing solver buffers for %s" % mesh.vtk_file_name)
+        n_obs = len(self.receiver_locations)
+        if max(mesh.ncells, mesh.npts, n_obs) > MAX_ARRAY_SIZE:
             msg = (
-                "Length of ambient magnetic field has to be exactly 3, passed a length of %d"
-                % len(ambient_magnetic_field)
+                "Mesh %s (%d cells, %d points) with %d receivers exceeds the solver limit of %d"
+                % (mesh.vtk_file_name, mesh.ncells, mesh.npts, n_obs, MAX_ARRAY_SIZE)
             )
             log.error(msg)
             raise ValueError(msg)
 
-        self.Bx = ambient_magnetic_field[0]
-        self.By = ambient_magnetic_field[1]
-        self.Bz = ambient_magnetic_field[2]
-        self.Bv = np.sqrt(self.Bx**2 + self.By**2 + self.Bz**2)
-
-        self.LX = self.Bx / self.Bv
-        self.LY = self.By / self.Bv
-        self.LZ = self.Bz / self.Bv
+        self._ctet = self._fill_buffer(
+            "ctet", mesh.centroids, mesh.ncells, (MAX_ARRAY_SIZE, 3)
+        )
+        self._vtet = self._fill_buffer(
+            "vtet", mesh.volumes, mesh.ncells, (MAX_ARRAY_SIZE)
+        )
+        self._nodes = self._fill_buffer(
+            "nodes", mesh.nodes, mesh.npts, (MAX_ARRAY_SIZE, 3)
+        )
+        self._tets = self._fill_buffer(
+            "tets",
+            mesh.tet_nodes + 1,
+            mesh.ncells,
+            (MAX_ARRAY_SIZE, 4),
+            dtype=TETS_DTYPE,
+        )
 
-        log.debug("Solver initialization done!")
+        self._n_obs = n_obs
+        self._obs_pts = self._fill_buffer(
+            "obs_pts", self.receiver_locations, self._n_obs, (MAX_ARRAY_SIZE, 3)
+        )
+        self._mesh = mesh
 
     def solve(
         self,
@@ -229,32 +356,20 @@ class MagneticSolver:
         magnetic_properties: MagneticProperties,
         mode: Literal["adjoint", "forward"],
     ) -> np.ndarray:
-        rho_sus = np.zeros((1000000), dtype=float)
-        rho_sus[0 : mesh.ncells] = magnetic_properties.susceptibility
-
-        ctet = np.zeros((1000000, 3), dtype=float)
-        ctet[0 : mesh.ncells] = mesh.centroids
-
-        vtet = np.zeros((1000000), dtype=float)
-        vtet[0 : mesh.ncells] = mesh.volumes
-
-        nodes = np.zeros((1000000, 3), dtype=float)
-        nodes[0 : mesh.npts] = mesh.nodes
-
-        tets = np.zeros((1000000, 4), dtype=int)
-        tets[0 : mesh.ncells] = mesh.tet_nodes + 1
-
-        n_obs = len(self.receiver_locations)
-        rx_loc = self.receiver_locations.to_numpy()
+        if self._mesh is not mesh:
+            self.prepare(mesh)
+
+        rho_sus = self._fill_buffer(
+            "rho_sus",
+            magnetic_properties.susceptibility,
+            mesh.ncells,
+            (MAX_ARRAY_SIZE),
+        )
+        rho_sus[0 : mesh.ncells] *= self.Bv
 
         ismag = True
-        rho_sus = rho_sus * self.Bv
-
         istensor = False
 
-        obs_pts = np.zeros((1000000, 3), dtype=float)
-        obs_pts[0:n_obs] = rx_loc[:, 0:3]
-
         if mode == "adjoint":
             if (
                 isinstance(magnetic_properties.kx, float)
@@ -274,13 +389,13 @@ class MagneticSolver:
                     self.LX,
                     self.LY,
                     self.LZ,
-                    nodes,
-                    tets,
+                    self._nodes,
+                    self._tets,
                     mesh.ncells,
-                    obs_pts,
-                    n_obs,
-                    ctet,
-                    vtet,
+                    self._obs_pts,
+                    self._n_obs,
+                    self._ctet,
+                    self._vtet,
                 )
                 log.debug("Adjoint solver done for %s" % magnetic_properties.file_name)
                 output = adjoint_output[0 : mesh.ncells]
@@ -301,14 +416,15 @@ class MagneticSolver:
             log.debug(
                 "Forward solver in progress for %s" % magnetic_properties.file_name
             )
-            kx = np.zeros((1000000), dtype=float)
-            kx[0 : mesh.ncells] = magnetic_properties.kx
-
-            ky = np.zeros((1000000), dtype=float)
-            ky[0 : mesh.ncells] = magnetic_properties.ky
-
-            kz = np.zeros((1000000), dtype=float)
-            kz[0 : mesh.ncells] = magnetic_properties.kz
+            kx = self._fill_buffer(
+                "kx", magnetic_properties.kx, mesh.ncells, (MAX_ARRAY_SIZE)
+            )
+            ky = self._fill_buffer(
+                "ky", magnetic_properties.ky, mesh.ncells, (MAX_ARRAY_SIZE)
+            )
+            kz = self._fill_buffer(
+                "kz", magnetic_properties.kz, mesh.ncells, (MAX_ARRAY_SIZE)
+            )
 
             forward_output = forward.forward(
                 rho_sus,
@@ -320,17 +436,24 @@ class MagneticSolver:
                 self.LX,
                 self.LY,
                 self.LZ,
-                nodes,
-                tets,
+                self._nodes,
+                self._tets,
                 mesh.ncells,
-                obs_pts,
-                n_obs,
+                self._obs_pts,
+                self._n_obs,
             )
-            output = forward_output[0:n_obs]
+            output = forward_output[0 : self._n_obs]
             log.debug("Forward solver is done for %s" % magnetic_properties.file_name)
         return output
 
 
+def load_mesh(vtk_file_name: Union[str, os.PathLike]) -> Mesh:
+    mesh = Mesh(vtk_file_name)
+    mesh.get_centroids()
+    mesh.get_volumes()
+    return mesh
+
+
 @click.group()
 def isciml():
     log.info("isciml ... ")
@@ -407,9 +530,11 @@ def generate(**kwargs):
     if os.path.isdir(vtk_path):
         vtk_files = glob.glob(vtk_path + "/*.vtk")
 
+    # The ambient field is the same for every file, so it is set up only once.
+    ambient_field = AmbientField(kwargs["ambient_field"])
     solver = MagneticSolver(
         kwargs["receiver_file"],
-        kwargs["ambient_field"],
+        ambient_field,
         kwargs["receiver_file_has_header"],
         kwargs["perturb_receiver_z"],
     )
@@ -428,8 +553,14 @@ def generate(**kwargs):
             os.mkdir(output_folder)
 
     # Reading magnetic properites files and distributing them across processes
-    if os.path.exists(kwargs["input_folder"]):
-        numpy_files = glob.glob(kwargs["input_folder"] + "/*.npy")
+    # A single scandir pass lists the files; its entries carry the file type, so
+    # no further stat calls are needed per file.
+    if os.path.isdir(kwargs["input_folder"]):
+        numpy_files = sorted(
+            entry.path
+            for entry in os.scandir(kwargs["input_folder"])
+            if entry.is_file() and entry.name.endswith(".npy")
+        )
     else:
         msg = "Folder %s does not exist or readable" % kwargs["input_folder"]
         log.error(msg)
@@ -445,30 +576,34 @@ def generate(**kwargs):
         log.error(msg)
         sys.exit(1)
 
-    files_per_proc = total_files / size
-    start_file_index = int(rank * files_per_proc)
-
-    if rank == (size - 1):
-        end_file_index = total_files
-    else:
-        end_file_index = int((rank + 1) * files_per_proc)
-    log.info(
-        "start_file_index = %d, end_file_index = %d"
-        % (start_file_index, end_file_index)
-    )
-    log.info(
-        "Processing %d files " % (len(numpy_files[start_file_index:end_file_index]))
-    )
-
-    for _file in track(
-        numpy_files[start_file_index:end_file_index], description="Rank %d" % rank
+    # Files are dealt out round-robin so that ranks get an even mix of slow and
+    # fast solves; the sorted listing keeps the assignment identical on every rank.
+    rank_files = numpy_files[rank::size]
+    log.info("Processing %d of %d files " % (len(rank_files), total_files))
+
+    # Only the current mesh is kept; it is reused, and the solver's mesh buffers
+    # are only refilled, when the next sampled mesh is a different file.
+    mesh_file = None
+    mesh = None
+    if len(vtk_files) == 1:
+        mesh_file = vtk_files[0]
+        mesh = load_mesh(mesh_file)
+        solver.prepare(mesh)
+
+    # Rich re-renders its progress bar on every step; tqdm is throttled instead.
+    for _file in tqdm(
+        rank_files,
+        desc="Rank %d" % rank,
+        mininterval=2.0,
+        miniters=max(1, len(rank_files) // 100),
     ):
-        properties = MagneticProperties(_file, kwargs["ambient_field"])
+        properties = MagneticProperties(_file, ambient_field)
 
-        mesh_file = sample(vtk_files,1)
-        mesh = Mesh(mesh_file[0])
-        mesh.get_centroids()
-        mesh.get_volumes()
+        next_mesh_file = sample(vtk_files, 1)[0]
+        if next_mesh_file != mesh_file:
+            mesh = None
+            mesh_file = next_mesh_file
+            mesh = load_mesh(mesh_file)
 
         output = solver.solve(mesh, properties, mode=kwargs["solver"])
         _file_name = _file.split("/")[-1]
@@ -478,7 +613,11 @@ def generate(**kwargs):
             output_prefix = kwargs["solver"]
 
         adjoint_file_name = output_folder + "/" + output_prefix + "_" + _file_name
-        np.save(adjoint_file_name, output)
+        np.save(
+            adjoint_file_name,
+            output.astype(np.float32, copy=False),
+            allow_pickle=False,
+        )
 
     return 0
 
@@ -486,13 +625,13 @@ def generate(**kwargs):
 @isciml.command()
 @click.option(
     "--sample_folder",
-    help="Folder with files containing samples",
+    help="Folder with files containing samples, or a single 2D .npy file with one sample per row",
     type=click.Path(),
     required=True,
 )
 @click.option(
     "--target_folder",
-    help="Folder with files containing targets",
+    help="Folder with files containing targets, or a single 2D .npy file with one target per row",
     type=click.Path(),
     required=True,
 )
@@ -638,11 +777,22 @@ def train(**kwargs) -> int:
         npydataset, [train_size, test_size]
     )
 
+    # Pinned host memory lets batches be copied to the GPU asynchronously.
+    pin_memory = torch.cuda.is_available()
+    persistent_workers = num_workers > 0
     train_dataloader = DataLoader(
-        train_dataset, batch_size=batch_size, num_workers=num_workers
+        train_dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers,
     )
     test_dataloader = DataLoader(
-        test_dataset, batch_size=batch_size, num_workers=num_workers
+        test_dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers,
     )
 
     model = LitAutoEncoder(
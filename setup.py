@@ -11,6 +11,7 @@ setup(
         "click==8.1.3",
         "mpi4py==3.1.4",
         "numpy==1.21.6",
+        "numba==0.56.4",
         "pandas==1.3.5",
         "black==23.1.0",
         "pyaml==21.10.1",
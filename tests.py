@@ -1,5 +1,20 @@
 from unittest import TestCase
-from isciml import Mesh
+from unittest import mock
+import os
+import pickle
+import tempfile
+import numpy as np
+import torch
+from isciml import (
+    Mesh,
+    AmbientField,
+    MagneticSolver,
+    TETS_DTYPE,
+    load_mesh,
+    _tet_volumes,
+    _tet_volumes_numpy,
+)
+from train import MEDIAN_CACHE_FILE, NumpyDataset, _reshape_fill, _reshape_fill_numpy
 
 
 class TestMesh(TestCase):
@@ -7,3 +22,169 @@ class TestMesh(TestCase):
         fn = "test.vtk"
         mesh = Mesh(fn)
         print(mesh)
+
+    def test_volumes(self):
+        mesh = Mesh("test.vtk")
+        mesh.get_volumes()
+
+        # Scalar triple product per tetrahedron, as in the original loop.
+        x1, y1, z1 = mesh.nodes[mesh.tet_nodes[:, 0]].T
+        x2, y2, z2 = mesh.nodes[mesh.tet_nodes[:, 1]].T
+        x3, y3, z3 = mesh.nodes[mesh.tet_nodes[:, 2]].T
+        x4, y4, z4 = mesh.nodes[mesh.tet_nodes[:, 3]].T
+        pv = (
+            (x4 - x1) * ((y2 - y1) * (z3 - z1) - (z2 - z1) * (y3 - y1))
+            + (y4 - y1) * ((z2 - z1) * (x3 - x1) - (x2 - x1) * (z3 - z1))
+            + (z4 - z1) * ((x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1))
+        )
+        expected = np.abs(pv / 6.0)
+        # Nearly flat cells differ only by rounding, so the absolute tolerance
+        # is scaled to the mesh.
+        atol = 1e-12 * expected.max()
+
+        np.testing.assert_allclose(mesh.volumes, expected, rtol=1e-9, atol=atol)
+        for kernel in (_tet_volumes, _tet_volumes_numpy):
+            out = np.empty(mesh.ncells)
+            kernel(mesh.nodes, mesh.tet_nodes, out)
+            np.testing.assert_allclose(out, expected, rtol=1e-9, atol=atol)
+
+    def test_centroids(self):
+        mesh = Mesh("test.vtk")
+        mesh.get_centroids()
+
+        nodes = mesh.nodes
+        tets = mesh.tet_nodes
+        expected = (
+            nodes[tets[:, 0]] + nodes[tets[:, 1]] + nodes[tets[:, 2]] + nodes[tets[:, 3]]
+        ) / 4.0
+        np.testing.assert_allclose(mesh.centroids, expected)
+
+
+class TestMagneticSolver(TestCase):
+    def test_solver_from_ambient_field(self):
+        ambient_field = AmbientField([820.5, 16241.7, 53380.0])
+        solver = MagneticSolver(
+            "data/receiver_locations.csv", ambient_field, False, False
+        )
+        self.assertEqual(solver.receiver_locations.shape[1], 3)
+        self.assertAlmostEqual(solver.Bv, ambient_field.Bv)
+        self.assertAlmostEqual(
+            solver.LX**2 + solver.LY**2 + solver.LZ**2, 1.0, places=12
+        )
+
+    def test_prepare_clears_rows_of_larger_mesh(self):
+        ambient_field = AmbientField([820.5, 16241.7, 53380.0])
+        solver = MagneticSolver(
+            "data/receiver_locations.csv", ambient_field, False, False
+        )
+        large = load_mesh("test.vtk")
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, "small.vtk")
+            large.mesh.extract_cells(range(10)).save(fn)
+            small = load_mesh(fn)
+        self.assertLess(small.npts, large.npts)
+
+        solver.prepare(large)
+        buffers = (solver._ctet, solver._vtet, solver._nodes, solver._tets)
+        solver.prepare(small)
+
+        # The padded buffers are reused, with the rows of the larger mesh zeroed.
+        for old, new in zip(buffers, (solver._ctet, solver._vtet, solver._nodes, solver._tets)):
+            self.assertIs(old, new)
+        n = small.ncells
+        np.testing.assert_array_equal(solver._ctet[:n], small.centroids)
+        np.testing.assert_array_equal(solver._vtet[:n], small.volumes)
+        np.testing.assert_array_equal(solver._tets[:n], small.tet_nodes + 1)
+        np.testing.assert_array_equal(solver._nodes[: small.npts], small.nodes)
+        self.assertFalse(solver._ctet[n:].any())
+        self.assertFalse(solver._vtet[n:].any())
+        self.assertFalse(solver._tets[n:].any())
+        self.assertFalse(solver._nodes[small.npts :].any())
+        self.assertEqual(solver._tets.dtype, TETS_DTYPE)
+        self.assertTrue(solver._tets.flags.f_contiguous)
+
+
+class TestReshapeFill(TestCase):
+    def test_reshape_fill_matches_pad(self):
+        src = np.random.rand(37)
+        expected = np.pad(src, (6, 5), constant_values=0.5).astype(np.float32)
+        for fill in (_reshape_fill, _reshape_fill_numpy):
+            dst = np.empty(48, dtype=np.float32)
+            fill(src, dst, 6, 0.5)
+            np.testing.assert_array_equal(dst, expected)
+
+
+class TestNumpyDataset(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.samples = np.random.rand(4, 50)
+        self.targets = np.random.rand(4, 50)
+
+        self.sample_file = os.path.join(self.tmp.name, "samples.npy")
+        self.target_file = os.path.join(self.tmp.name, "targets.npy")
+        np.save(self.sample_file, self.samples)
+        np.save(self.target_file, self.targets)
+
+        self.sample_dir = os.path.join(self.tmp.name, "samples")
+        self.target_dir = os.path.join(self.tmp.name, "targets")
+        os.mkdir(self.sample_dir)
+        os.mkdir(self.target_dir)
+        for i in range(len(self.samples)):
+            np.save(os.path.join(self.sample_dir, "sample_%02d.npy" % i), self.samples[i])
+            np.save(os.path.join(self.target_dir, "target_%02d.npy" % i), self.targets[i])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_packed_matches_folders(self):
+        packed = NumpyDataset(self.sample_file, self.target_file, "eight")
+        folders = NumpyDataset(self.sample_dir, self.target_dir, "eight")
+        self.assertTrue(packed.packed)
+        self.assertEqual(len(packed), len(folders))
+        for i in range(len(packed)):
+            for a, b in zip(packed[i], folders[i]):
+                self.assertTrue(torch.equal(a, b))
+
+    def test_packed_pickle(self):
+        packed = NumpyDataset(self.sample_file, self.target_file, "eight")
+        packed[0]
+        restored = pickle.loads(pickle.dumps(packed))
+        self.assertIsNone(restored._samples)
+        for i in range(len(packed)):
+            for a, b in zip(packed[i], restored[i]):
+                self.assertTrue(torch.equal(a, b))
+
+    def test_median_cache(self):
+        NumpyDataset(self.sample_dir, self.target_dir, "eight")
+        self.assertTrue(os.path.isfile(os.path.join(self.sample_dir, MEDIAN_CACHE_FILE)))
+        self.assertTrue(os.path.isfile(os.path.join(self.target_dir, MEDIAN_CACHE_FILE)))
+
+        with mock.patch("train.np.median", wraps=np.median) as median:
+            NumpyDataset(self.sample_dir, self.target_dir, "eight")
+        self.assertEqual(median.call_count, 0)
+
+        # A rewrite that keeps the mtime but changes the size is detected.
+        changed = os.path.join(self.sample_dir, "sample_01.npy")
+        mtime_ns = os.stat(changed).st_mtime_ns
+        new_sample = (np.random.rand(50) + 10.0).astype(np.float32)
+        np.save(changed, new_sample)
+        os.utime(changed, ns=(mtime_ns, mtime_ns))
+
+        with mock.patch("train.np.median", wraps=np.median) as median:
+            ds = NumpyDataset(self.sample_dir, self.target_dir, "eight")
+        self.assertEqual(median.call_count, 1)
+        self.assertEqual(ds._sample_med[changed], np.median(new_sample))
+
+        # So is a same-size rewrite whose mtime differs by a nanosecond.
+        new_sample = np.random.rand(50).astype(np.float32) + 20.0
+        np.save(changed, new_sample)
+        os.utime(changed, ns=(mtime_ns + 1, mtime_ns + 1))
+
+        with mock.patch("train.np.median", wraps=np.median) as median:
+            ds = NumpyDataset(self.sample_dir, self.target_dir, "eight")
+        self.assertEqual(median.call_count, 1)
+        self.assertEqual(ds._sample_med[changed], np.median(new_sample))
+
+    def test_mixed_file_and_folder(self):
+        with self.assertRaises(ValueError):
+            NumpyDataset(self.sample_file, self.target_dir, "eight")
@@ -6,18 +6,45 @@ import model
 import numpy as np
 import glob, os
 import logging
-from rich.logging import RichHandler
 from rich.progress import track
 
+try:
+    from numba import njit
 
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET",
-    # format="Rank: " + str(rank) + "/" + str(size) + ": %(asctime)s - %(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler()],
-)
-log = logging.getLogger("rich")
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+# Logging is configured by isciml; only the training data path is kept at INFO
+# so per-item debug records are not rendered.
+log = logging.getLogger("rich.train")
+log.setLevel(logging.INFO)
+
+MEDIAN_CACHE_FILE = ".medians.npz"
+
+
+def _reshape_fill_numpy(src, dst, left_pad, median):
+    end = left_pad + src.shape[0]
+    dst[:left_pad] = median
+    dst[left_pad:end] = src
+    dst[end:] = median
+
+
+if HAS_NUMBA:
+
+    @njit(cache=True)
+    def _reshape_fill(src, dst, left_pad, median):
+        end = left_pad + src.shape[0]
+        for i in range(left_pad):
+            dst[i] = median
+        for i in range(src.shape[0]):
+            dst[left_pad + i] = src[i]
+        for i in range(end, dst.shape[0]):
+            dst[i] = median
+
+else:
+    _reshape_fill = _reshape_fill_numpy
 
 
 class LitAutoEncoder(pl.LightningModule):
@@ -58,24 +85,45 @@ class NumpyDataset(Dataset):
         self.sample_dir = sample_dir
         self.target_dir = target_dir
 
+        # A sample/target path may also be a single 2D .npy file holding one
+        # sample per row, which is memory-mapped once instead of opening a file
+        # per item.
+        self.packed = os.path.isfile(sample_dir)
+        if self.packed != os.path.isfile(target_dir):
+            msg = (
+                "Samples %s and targets %s must both be .npy files or both be folders"
+                % (sample_dir, target_dir)
+            )
+            log.error(msg)
+            raise ValueError(msg)
         self.sample_files = []
-        _input_sample_files = sorted(os.listdir(sample_dir))
-        for _item in _input_sample_files:
-            fname = self.sample_dir + "/" + _item
-            if os.path.isfile(fname) and fname.endswith(".npy"):
-                self.sample_files.append(fname)
-
         self.target_files = []
-        _input_target_files = sorted(os.listdir(target_dir))
-        for _item in _input_target_files:
-            fname = self.target_dir + "/" + _item
-            if os.path.isfile(fname) and fname.endswith(".npy"):
-                self.target_files.append(fname)
+        self._samples = None
+        self._targets = None
+
+        if self.packed:
+            samples, targets = self._packed_arrays()
+            assert samples.ndim == 2 and targets.ndim == 2
+            assert len(samples) > 0
+            assert samples.shape == targets.shape
+            npvec = samples[0]
+        else:
+            _input_sample_files = sorted(os.listdir(sample_dir))
+            for _item in _input_sample_files:
+                fname = self.sample_dir + "/" + _item
+                if os.path.isfile(fname) and fname.endswith(".npy"):
+                    self.sample_files.append(fname)
+
+            _input_target_files = sorted(os.listdir(target_dir))
+            for _item in _input_target_files:
+                fname = self.target_dir + "/" + _item
+                if os.path.isfile(fname) and fname.endswith(".npy"):
+                    self.target_files.append(fname)
 
-        assert len(self.sample_files) > 0
-        assert len(self.sample_files) == len(self.target_files)
+            assert len(self.sample_files) > 0
+            assert len(self.sample_files) == len(self.target_files)
 
-        npvec = np.load(self.sample_files[0])
+            npvec = np.load(self.sample_files[0], mmap_mode="r", allow_pickle=False)
 
         ncells = len(npvec)
         nc_sqrt = int(np.sqrt(ncells))
@@ -107,8 +155,6 @@ class NumpyDataset(Dataset):
         npad = nrows * ncols - ncells
         left_pad = 0
         if npad > 0:
-            npmed = np.median(npvec)
-            npnew = npmed * np.ones((ncells + npad), dtype=float)
             min_pad, rem_val = np.divmod(npad, 2)
             if rem_val == 0:
                 left_pad = min_pad
@@ -122,35 +168,143 @@ class NumpyDataset(Dataset):
         self.npad = npad
         log.info("Input shape = %d, Output shape = %d x %d\n" % (ncells, nrows, ncols))
 
+        # Padding uses the per-file median, so compute it once per file instead of
+        # on every __getitem__ call.
+        self._sample_med = {}
+        self._tgt_med = {}
+        if self.npad and self.packed:
+            self._sample_med = np.array([np.median(row) for row in samples])
+            self._tgt_med = np.array([np.median(row) for row in targets])
+        elif self.npad:
+            self._sample_med = self._load_medians(self.sample_dir, self.sample_files)
+            self._tgt_med = self._load_medians(self.target_dir, self.target_files)
+
+    def __getstate__(self):
+        # DataLoader workers reopen the memory maps instead of receiving a pickled
+        # copy of the whole packed dataset.
+        state = self.__dict__.copy()
+        state["_samples"] = None
+        state["_targets"] = None
+        return state
+
+    def _packed_arrays(self):
+        if self._samples is None:
+            self._samples = np.load(self.sample_dir, mmap_mode="r", allow_pickle=False)
+            self._targets = np.load(self.target_dir, mmap_mode="r", allow_pickle=False)
+        return self._samples, self._targets
+
+    def _load_medians(self, directory, files):
+        cache_file = os.path.join(directory, MEDIAN_CACHE_FILE)
+        cached = {}
+        if os.path.isfile(cache_file):
+            try:
+                with np.load(cache_file, allow_pickle=False) as cache:
+                    for name, mtime_ns, size, median in zip(
+                        cache["names"],
+                        cache["mtimes_ns"],
+                        cache["sizes"],
+                        cache["medians"],
+                    ):
+                        cached[str(name)] = ((int(mtime_ns), int(size)), median)
+            except Exception as e:
+                log.warning("Ignoring median cache %s: %s" % (cache_file, e))
+
+        medians = {}
+        names, mtimes_ns, sizes, values = [], [], [], []
+        updated = False
+        for fname in files:
+            name = os.path.basename(fname)
+            # Nanosecond mtime and size together catch most rewrites that land
+            # within the filesystem's timestamp resolution.
+            st = os.stat(fname)
+            key = (st.st_mtime_ns, st.st_size)
+            if name in cached and cached[name][0] == key:
+                median = cached[name][1]
+            else:
+                median = np.median(np.load(fname, mmap_mode="r", allow_pickle=False))
+                updated = True
+            medians[fname] = median
+            names.append(name)
+            mtimes_ns.append(st.st_mtime_ns)
+            sizes.append(st.st_size)
+            values.append(median)
+
+        if updated:
+            tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+            try:
+                with open(tmp_file, "wb") as f:
+                    np.savez(
+                        f,
+                        names=np.array(names),
+                        mtimes_ns=np.array(mtimes_ns, dtype=np.int64),
+                        sizes=np.array(sizes, dtype=np.int64),
+                        medians=np.array(values),
+                    )
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                log.warning("Could not write median cache %s: %s" % (cache_file, e))
+
+        return medians
+
     def __len__(self):
+        if self.packed:
+            return len(self._packed_arrays()[0])
         return len(self.sample_files)
 
-    def _reshape_1d_to_2d(self, array: np.ndarray):
+    def _reshape_1d_to_2d(self, array: np.ndarray, median: float = None):
         if array.ndim != 1:
             raise ValueError("Input array must be 1D.")
+        if array.shape[0] != self.ncells:
+            raise ValueError(
+                "Input array has %d values, expected %d."
+                % (array.shape[0], self.ncells)
+            )
 
-        npmed = np.median(array)
-        npnew = npmed * np.ones((self.ncells + self.npad), dtype=np.float32)
-        npnew[self.left_pad : self.ncells + self.left_pad] = array
-        out_array = npnew.reshape(1, self.nrows, self.ncols)
+        # The float32 cast happens while copying, so no converted copy of the
+        # (possibly memory-mapped) input is made. Only the padded ends are
+        # filled with the median.
+        out_array = np.empty((1, self.nrows, self.ncols), dtype=np.float32)
+        _reshape_fill(
+            np.asarray(array),
+            out_array.reshape(-1),
+            self.left_pad,
+            median if self.npad else 0.0,
+        )
 
         return out_array
 
     def __getitem__(self, idx):
-        log.info("Sample = %s, Target = %s"%(self.sample_files[idx],self.target_files[idx]))
-        sample = self._reshape_1d_to_2d(
-            np.load(self.sample_files[idx]).astype(np.float32)
-        )
-        target = self._reshape_1d_to_2d(
-            np.load(self.target_files[idx]).astype(np.float32)
-        )
-        return sample, target
+        if self.packed:
+            samples, targets = self._packed_arrays()
+            sample_array = samples[idx]
+            target_array = targets[idx]
+            sample_med = self._sample_med[idx] if self.npad else None
+            target_med = self._tgt_med[idx] if self.npad else None
+        else:
+            sample_file = self.sample_files[idx]
+            target_file = self.target_files[idx]
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sample = %s, Target = %s" % (sample_file, target_file))
+            sample_array = np.load(sample_file, mmap_mode="r", allow_pickle=False)
+            target_array = np.load(target_file, mmap_mode="r", allow_pickle=False)
+            sample_med = self._sample_med.get(sample_file)
+            target_med = self._tgt_med.get(target_file)
+
+        sample = self._reshape_1d_to_2d(sample_array, sample_med)
+        target = self._reshape_1d_to_2d(target_array, target_med)
+        return torch.from_numpy(sample), torch.from_numpy(target)
 
 
 # n_blocks, start_filters, learning_rate, batch size, epochs, sample folder, target folder, training logs folder
 
 # npydataset = NumpyDataset("/tmp/samples/", "/tmp/targets")
-# dataloader = DataLoader(npydataset, batch_size=1)
+# dataloader = DataLoader(
+#     npydataset,
+#     batch_size=1,
+#     num_workers=os.cpu_count(),
+#     pin_memory=True,
+#     persistent_workers=True,
+# )
 
 # model = LitAutoEncoder()
 # trainer = pl.Trainer()